@@ -1,89 +1,158 @@
 import math
 import time
 import logging
+from typing import Callable
 
 import imageio
-from PIL import Image
+import numpy
+from PIL import Image, ImageSequence
 
 class Animation:
     """
         Represents an animation and provides playback utilities
     """
-    def __init__(self, filepath:str, cache_limit:int=128):
+    BLANK_FRAME = (Image.new("RGB", (16, 16), "black"), bytes(16*16*3))  # Shown before the first frame is decoded
+
+    def __init__(self, filepath:str, cache_limit:int=128, preprocess:Callable=None):
         """ Creates an instance of Animation
         
         Args:
             filepath: The filepath to the animation to load
             cache_limit: (OPTIONAL) Indicates the limit on frames to stop caching
+            preprocess: (OPTIONAL) Called on the left screen of each frame as it is decoded, e.g. to apply flips
         """
         self._filepath = filepath
+        self._preprocess = preprocess
         self._cache = []
+        self._frame_buf = numpy.zeros((16, 32, 3), dtype=numpy.uint8)  # Reused for every decoded frame
         self._frame_number = 0
         self._current_frame = None
         self._reader = None
-        self._frame_delay = 1
-        self._next_frame_timer = 0
+        self._frame_delay = 0.02  # Seconds, kept if the file has no timing information
+        self._frame_rate = 50
+        self._start_time = 0
         self.frames = 0
         self.playing = False
 
-        logging.debug(f"Reading expression file {filepath}")
+        logging.debug("Reading expression file %s", filepath)
+        if not self._load_with_pillow(filepath, cache_limit):
+            self._load_with_imageio(filepath, cache_limit)
+
+        self._frame_rate = 1 / self._frame_delay  # Frames per second, saves a division every frame
+        logging.debug("\tExpression has %s frames and a rate of %ss", self.frames, self._frame_delay)
+
+    def _load_with_pillow(self, filepath:str, cache_limit:int) -> bool:
+        """ Caches the animation using pillow's own decoder, used for formats such as GIF
+
+        Args:
+            filepath: The filepath to the animation to load
+            cache_limit: Indicates the limit on frames to stop caching
+        Returns:
+            bool: Whether the animation was loaded, False if pillow can't read it or it is over the cache limit
+        """
+        try:
+            image = Image.open(filepath)
+        except OSError:
+            return False  # Not an image pillow understands, e.g. a video
+
+        with image:
+            frames = getattr(image, "n_frames", 1)
+            if frames >= cache_limit:
+                return False
+
+            self.frames = frames
+            if image.info.get("duration"):
+                self._frame_delay = image.info["duration"] / 1000
+
+            logging.debug("\tCaching expression frames...")
+            for frame in ImageSequence.Iterator(image):
+                self._cache.append(self._split_frame(numpy.asarray(frame.convert("RGB"))))
+        return True
+
+    def _load_with_imageio(self, filepath:str, cache_limit:int):
+        """ Loads the animation using imageio, caching it if under the cache limit
+
+        Args:
+            filepath: The filepath to the animation to load
+            cache_limit: Indicates the limit on frames to stop caching
+        """
         reader = imageio.get_reader(filepath)
         self.frames = reader.get_length()
         if self.frames == math.inf:
             self.frames = reader.count_frames()
-            meta = reader.get_meta_data()
 
-            if "fps" in meta:
-                self._frame_delay = 1000 / float(meta["fps"])
-            elif "duration" in meta:
-                self._frame_delay = int(meta["duration"])
-        
-        logging.debug(f"\tExpression has {self.frames} frames and a rate of {self._frame_delay}s")
+        meta = reader.get_meta_data()
+        if meta.get("fps"):
+            self._frame_delay = 1 / float(meta["fps"])
+        elif meta.get("duration"):
+            self._frame_delay = int(meta["duration"]) / 1000
 
         if self.frames < cache_limit:
-            logging.info(f"\tCaching expression frames...")
-            for _ in range(self.frames):
-                raw_frame = reader.get_next_data()
-                self._cache.append(Image.fromarray(raw_frame).crop((0, 0, 32, 16)))
+            logging.debug("\tCaching expression frames...")
+            for index in range(self.frames):
+                raw_frame = reader.get_data(index)
+                self._cache.append(self._split_frame(raw_frame))
         else:
             logging.debug("\tExpression frames are over cache limit, not storing!")
-    
+
+    def _split_frame(self, raw_frame:numpy.ndarray) -> tuple:
+        """ Crops a decoded frame to (32x16) and splits it into the two screens
+
+        Args:
+            raw_frame: The decoded frame from the reader
+        Returns:
+            tuple: The left screen as a pillow image and the right screen as raw RGB bytes
+        """
+        frame = self._frame_buf
+        if raw_frame.ndim == 2:  # Greyscale
+            raw_frame = raw_frame[:, :, numpy.newaxis]
+        region = raw_frame[:16, :32, :3]
+        numpy.copyto(frame[:region.shape[0], :region.shape[1]], region)
+
+        # Both halves are copied out below so the buffer is free to reuse
+        left_screen = Image.fromarray(frame[:, :16])
+        if self._preprocess is not None:
+            left_screen = self._preprocess(left_screen)
+
+        return left_screen, frame[:, 16:].tobytes()
+
     def start(self):
         """ Starts the animation from the begining """
-        self._frame_number = 0
-        self._next_frame_timer = time.monotonic()
+        self._frame_number = -1  # Nothing shown yet
+        self._start_time = time.monotonic()
         self.playing = True
 
         if not self._cache:
             self._reader = imageio.get_reader(self._filepath)
-    
-    def get_frame(self) -> Image.Image:
-        """ Gets the current frame of the animation
-        
+
+    def get_frame_split(self) -> tuple:
+        """ Gets the current frame of the animation already split into the two screens
+
         Returns:
-            Image.Image: The pillow image representing the frame
+            tuple: The left screen as a pillow image and the right screen as raw RGB bytes
         """
-        if time.monotonic() > self._next_frame_timer:
-            self._next_frame_timer += self._frame_delay / 1000
-            self._frame_number = (self._frame_number+1) % self.frames
+        # Work out the frame from the time since start so late calls never drift
+        last_frame = self._frame_number
+        frame_number = int((time.monotonic() - self._start_time) * self._frame_rate) % self.frames
 
+        if frame_number != last_frame:
             if self._cache:
-                self._current_frame = self._cache[self._frame_number].copy()
+                self._current_frame = self._cache[frame_number]
             else:
-                if self._frame_number == 0:
-                    self._reader.set_image_index(0)
-                
+                # Readers only seek when the index isn't the one after the last read
                 try:
-                    raw_frame = self._reader.get_next_data()
-                except IndexError:
-                    self._frame_number = 0
-                    self._reader.set_image_index(0)
-                    raw_frame = self._reader.get_next_data()
+                    raw_frame = self._reader.get_data(frame_number)
+                except (IndexError, EOFError):  # Frame count was an estimate
+                    if frame_number > 0:
+                        self.frames = frame_number  # The first missing frame is the true count
+                    frame_number = int((time.monotonic() - self._start_time) * self._frame_rate) % self.frames
+                    raw_frame = self._reader.get_data(frame_number)
                 
-                self._current_frame = Image.fromarray(raw_frame).crop((0, 0, 32, 16))
-        
+                self._current_frame = self._split_frame(raw_frame)
+            self._frame_number = frame_number
+
         if self._current_frame is None:
-            return Image.new("RGB", (32, 16), "black")
+            return self.BLANK_FRAME
         else:
             return self._current_frame
 
@@ -19,9 +19,31 @@ class IHardware:
     @abstractmethod
     def draw_to_screens(self, image:Image.Image):
         """ Draws the given image to the screens
+        Animation frames should go through draw_split_to_screens instead, this is for images built on the fly
         
         Args:
-            image: The pillow image to draw, must be (32x16)
+            image: Any RGB pillow image to draw, must be (32x16)
+        """
+        raise NotImplementedError()
+
+    def prepare_screen(self, image:Image.Image) -> Image.Image:
+        """ Applies any fixed display transforms (such as flips) to a single screen image
+        Frames passed to draw_split_to_screens are expected to have been through this already
+
+        Args:
+            image: The pillow image of one screen (16x16)
+        Returns:
+            Image.Image: The image ready to be drawn
+        """
+        return image
+
+    @abstractmethod
+    def draw_split_to_screens(self, left_screen:Image.Image, right_screen:bytes):
+        """ Draws an image that has already been split into the two screens
+
+        Args:
+            left_screen: The prepared pillow image to draw on the left screen, must be (16x16)
+            right_screen: The raw RGB bytes to draw on the right screen
         """
         raise NotImplementedError()
 
@@ -1,5 +1,6 @@
 import logging
-import hashlib
+import struct
+import zlib
 import time
 from typing import Callable
 
@@ -12,7 +13,7 @@ if HD_EDITION:
 else:
     import unicornhat
 import RPi.GPIO as GPIO
-from PIL import Image, ImageOps
+from PIL import Image
 
 from hardware.IHardware import IHardware
 
@@ -21,8 +22,11 @@ class RaspberryPi(IHardware):
         The true raspberry pi libraries for robo neo
     """
 
+    HEADER = b'>I"\x05\x03\xf5'  # Marks the start of every frame sent over serial
     BUFFER_SIZE = 768
-    HASH_SIZE = 4  # Cannot be bigger than 16
+    HASH_SIZE = 4  # Size of the packed CRC32
+    FRAME_SIZE = len(HEADER) + BUFFER_SIZE + HASH_SIZE
+    SERIAL_REFRESH = 1  # Seconds before an unchanged frame is sent again, in case the slave dropped it
 
     BUTTON_ACTIVE_STATE = GPIO.LOW
 
@@ -35,14 +39,26 @@ class RaspberryPi(IHardware):
         """
         self.config = config
         self.trigger_fire = expression_trigger
+
+        # Config values used every frame
+        self._flip_h = config["Flip_horizontal"]
+        self._flip_v = config["Flip_vertical"]
+        self._serial_period = 1 / config["Serial_rate"]
+        self._release_expression = None if config["Sticky"] else config["Default"]
+
         self._serial_timer = None
+        self._serial_refresh = 0
+        self._last_right = None
+        self._last_left = None
+        self._screen_buf = numpy.zeros((16, 16, 3), dtype=numpy.uint8)  # Handed to the library, which clears it on off()
         self.serial = serial.Serial(
             config["Port"],
             baudrate=config["Serial_baudrate"],
             timeout=0.01
         )
         self.pin_to_expression = {}
-        self._button_changes = {}
+        self._pin_bit = {}
+        self._pressed = 0  # Bitmask of the buttons currently held down
 
         self._data_buffer = bytes()
 
@@ -58,7 +74,7 @@ class RaspberryPi(IHardware):
             GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
             self.pin_to_expression[pin] = expression
-            self._button_changes[pin] = False
+            self._pin_bit[pin] = 1 << len(self._pin_bit)
     
     def _on_button_press(self, pin:int):
         """ Called when a button is pressed
@@ -68,9 +84,10 @@ class RaspberryPi(IHardware):
             pin: The PIN of the button thas was pressed
         """
         if pin in self.pin_to_expression:
+            self._pressed |= self._pin_bit[pin]
             self.trigger_fire(self.pin_to_expression[pin])
         else:
-            logging.error(f"Unknown pin {pin} in press event")
+            logging.error("Unknown pin %s in press event", pin)
     
     def _on_button_release(self, pin:int):
         """ Called when a button is released
@@ -79,31 +96,51 @@ class RaspberryPi(IHardware):
         Args:
             pin: The PIN of the button thas was released
         """
-        down = sum([int(GPIO.input(i) == self.BUTTON_ACTIVE_STATE) for i in self.pin_to_expression.keys()])
-        if down == 0 and not self.config["Sticky"] and self.config["Default"]:
-            self.trigger_fire(self.config["Default"])
+        self._pressed &= ~self._pin_bit.get(pin, 0)
+        if self._pressed == 0 and self._release_expression:
+            self.trigger_fire(self._release_expression)
     
+    def prepare_screen(self, image:Image.Image) -> Image.Image:
+        """ Applies the configured flips to a single screen image
+
+        Args:
+            image: The pillow image of one screen (16x16)
+        Returns:
+            Image.Image: The image ready to be drawn
+        """
+        if self._flip_h:
+            image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        if self._flip_v:
+            image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        return image
+
     def _draw_image(self, image:Image.Image):
         """ Draws an image to the unicorn hat screens
         
         Args:
-            image: The pillow image to draw
+            image: The prepared pillow image to draw
+        """
+        # asarray of a pillow image is read-only, so copy into our own buffer
+        numpy.copyto(self._screen_buf, numpy.asarray(image, dtype=numpy.uint8))
+        self._draw_ndarray(self._screen_buf)
+
+    def _draw_ndarray(self, pixels:numpy.ndarray):
+        """ Draws raw pixels to the unicorn hat screens
+
+        Args:
+            pixels: The prepared (16x16x3) writeable uint8 array to draw, indexed by row then column
         """
-        if self.config["Flip_horizontal"]:
-            image = ImageOps.mirror(image)
-        if self.config["Flip_vertical"]:
-            image = ImageOps.flip(image)
-        
         if HD_EDITION:
             # Inject image into raw display buffer
-            unicornhathd._buf = numpy.array(image, dtype=int)
+            unicornhathd._buf = pixels
             unicornhathd.show()
         else:
             # Translation is difficult to the original library :(
-            for y in range(8):
-                for x in range(8):
-                    colour = image.getpixel((x, y))
-                    unicornhat.set_pixel(x, y, colour[0], colour[1], colour[2])
+            # Convert once to plain ints rather than calling getpixel per pixel
+            pixels = pixels[:8, :8, :3].tolist()
+            for y, row in enumerate(pixels):
+                for x, (r, g, b) in enumerate(row):
+                    unicornhat.set_pixel(x, y, r, g, b)
             unicornhat.show()
     
     def draw_to_screens(self, image:Image.Image):
@@ -112,48 +149,77 @@ class RaspberryPi(IHardware):
         Args:
             image: The pillow image to draw, must be (32x16)
         """
-        left_screen, right_screen = image.crop((0, 0, 16, 16)), image.crop((16, 0, 32, 16)).tobytes()
+        left_screen = self.prepare_screen(image.crop((0, 0, 16, 16)))
+        self.draw_split_to_screens(left_screen, image.crop((16, 0, 32, 16)).tobytes())
+
+    def draw_split_to_screens(self, left_screen:Image.Image, right_screen:bytes):
+        """ Draws an image that has already been split into the two screens
 
+        Args:
+            left_screen: The prepared pillow image to draw on the left screen, must be (16x16)
+            right_screen: The raw RGB bytes to send to the right screen
+        """
         if self._serial_timer is None:  # First time
             self._serial_timer = time.monotonic()
         
-        if time.monotonic() > self._serial_timer:
-            hasher = hashlib.md5()
-            hasher.update(right_screen)
-            right_screen += hasher.digest()[:self.HASH_SIZE]  # Add hash
-            self.serial.write(right_screen)
+        now = time.monotonic()
+        if now > self._serial_timer:
+            if right_screen != self._last_right or now > self._serial_refresh:
+                self._last_right = right_screen
+                self._serial_refresh = now + self.SERIAL_REFRESH
+
+                self.serial.write(b"".join((self.HEADER, right_screen, struct.pack("<I", zlib.crc32(right_screen)))))
 
-            self._serial_timer += 1 / self.config["Serial_rate"]
+            self._serial_timer += self._serial_period
 
-        self._draw_image(left_screen)
+        # Cached animation frames come back as the same object while unchanged
+        if left_screen is not self._last_left:
+            self._draw_image(left_screen)
+            self._last_left = left_screen
 
-        for pin in self.pin_to_expression.keys():
-            if (GPIO.input(pin) == self.BUTTON_ACTIVE_STATE) != self._button_changes[pin]:
-                self._button_changes[pin] = GPIO.input(pin) == self.BUTTON_ACTIVE_STATE
-                if self._button_changes[pin]:
+        for pin, bit in self._pin_bit.items():
+            pressed = GPIO.input(pin) == self.BUTTON_ACTIVE_STATE
+            if pressed != bool(self._pressed & bit):
+                if pressed:
                     self._on_button_press(pin)
                 else:
                     self._on_button_release(pin)
     
     def write_serial_to_display(self):
         """ Called ONLY as a slave in order to write incomming serial data to the hardware """
-        self._data_buffer += self.serial.read(self.BUFFER_SIZE+self.HASH_SIZE)
+        needed = self.FRAME_SIZE - len(self._data_buffer)
+        waiting = self.serial.in_waiting
+        # Take whatever has arrived without waiting, only block on the timeout when idle
+        self._data_buffer += self.serial.read(min(waiting, needed) if waiting else needed)
+
+        start = self._data_buffer.find(self.HEADER)
+        if start < 0:
+            # Out of sync, keep only what could be the beginning of the next header
+            self._data_buffer = self._data_buffer[-(len(self.HEADER)-1):]
+            return
+        elif start > 0:
+            logging.debug("Skipped %s bytes to the next frame header", start)
+            self._data_buffer = self._data_buffer[start:]
         
-        if not self._data_buffer:
-            pass  # No data sent
-        elif len(self._data_buffer) >= self.BUFFER_SIZE+self.HASH_SIZE:
-            screen_data, hashcode = self._data_buffer[:self.BUFFER_SIZE], self._data_buffer[self.BUFFER_SIZE:self.BUFFER_SIZE+self.HASH_SIZE]
-            hasher = hashlib.md5()
-            hasher.update(screen_data)
-            check_hash = hasher.digest()[:self.HASH_SIZE]
+        if len(self._data_buffer) >= self.FRAME_SIZE:
+            payload = self._data_buffer[len(self.HEADER):self.FRAME_SIZE]
+            screen_data, hashcode = payload[:self.BUFFER_SIZE], payload[self.BUFFER_SIZE:]
+            check_hash = struct.pack("<I", zlib.crc32(screen_data))
             if check_hash == hashcode:
-                image = Image.frombytes("RGB", (16, 16), screen_data)
-                self._draw_image(image)
-                self._data_buffer = self._data_buffer[self.BUFFER_SIZE+self.HASH_SIZE:]
+                # Flip with array views rather than going through a pillow image
+                pixels = numpy.frombuffer(screen_data, dtype=numpy.uint8).reshape(16, 16, 3)
+                if self._flip_h:
+                    pixels = pixels[:, ::-1]
+                if self._flip_v:
+                    pixels = pixels[::-1]
+                # The view is read-only, so copy it into our own buffer
+                numpy.copyto(self._screen_buf, pixels)
+                self._draw_ndarray(self._screen_buf)
+                self._data_buffer = self._data_buffer[self.FRAME_SIZE:]
             else:
-                logging.warning(f"Invalid hash {check_hash} != {hashcode}, message length {len(self._data_buffer)}")
-                self._data_buffer = bytes()
-                self.serial.reset_input_buffer()
+                logging.warning("Invalid hash %s != %s, message length %s", check_hash, hashcode, len(self._data_buffer))
+                # Drop this header so the next call resyncs on the following one
+                self._data_buffer = self._data_buffer[len(self.HEADER):]
     
     def teardown(self):
         """ Shutdown all hardware interfaces """
@@ -1,11 +1,13 @@
 import logging
-import hashlib
+import struct
+import zlib
 import time
 from typing import Callable
 from tkinter import *
 
 import serial
-from PIL import Image, ImageTk, ImageOps
+import numpy
+from PIL import Image, ImageTk
 
 from hardware.IHardware import IHardware
 
@@ -15,9 +17,9 @@ class Simulator(IHardware):
     """
     SCALE = 10
 
-    HEADER = b'>I"\x05\x03\xf5'  # Am too tired to do this right D:
+    HEADER = b'>I"\x05\x03\xf5'  # Marks the start of every frame sent over serial
     BUFFER_SIZE = 768
-    HASH_SIZE = 4  # Cannot be bigger than 16
+    HASH_SIZE = 4  # Size of the packed CRC32
 
     def __init__(self, config: dict, expression_trigger:Callable):
         """ Creates an instance of Simulator
@@ -35,8 +37,8 @@ class Simulator(IHardware):
         self.window.title("RoboNeo simulator")
         
         self.backdrop = Image.new("RGB", (32*self.SCALE, 16*self.SCALE), "black")
-        self.photo = None
-        self.label = Label(self.window)
+        self.photo = ImageTk.PhotoImage(self.backdrop)
+        self.label = Label(self.window, image=self.photo)
         self.label.pack(side=RIGHT)
 
         self._input_frame = LabelFrame(self.window, text="Input pins")
@@ -76,15 +78,32 @@ class Simulator(IHardware):
         Args:
             image: The pillow image to show
         """
-        self.backdrop.paste(ImageOps.scale(image, self.SCALE, Image.BOX), (0, 0))
-        
-        self.photo = ImageTk.PhotoImage(self.backdrop)
-        self.label.config(image=self.photo)
+        self._draw_pixels(numpy.asarray(image))
+
+    def _draw_pixels(self, pixels:numpy.ndarray):
+        """ Scales raw RGB pixels up and shows them on the virtual displays
+
+        Args:
+            pixels: The uint8 array to show, indexed by row then column
+        """
+        scaled = pixels.repeat(self.SCALE, axis=0).repeat(self.SCALE, axis=1)
+        self.backdrop.paste(Image.fromarray(scaled), (0, 0))
+        self.photo.paste(self.backdrop)  # Update the existing Tk image in place
         
         if time.monotonic() > self._next_update and not self.serial:
             self.window.update()
             self._next_update = time.monotonic() + 0.04
 
+    def draw_split_to_screens(self, left_screen:Image.Image, right_screen:bytes):
+        """ Draws an image that has already been split into the two virtual displays
+
+        Args:
+            left_screen: The pillow image to show on the left display
+            right_screen: The raw RGB bytes to show on the right display
+        """
+        right_pixels = numpy.frombuffer(right_screen, dtype=numpy.uint8).reshape(16, 16, 3)
+        self._draw_pixels(numpy.concatenate((numpy.asarray(left_screen), right_pixels), axis=1))
+
     def write_serial_to_display(self):
         """ Called ONLY as a slave in order to write incomming serial data to the hardware """
         if not self.serial:
@@ -93,26 +112,27 @@ class Simulator(IHardware):
                 baudrate=self.config["Serial_baudrate"],
                 timeout=0.1
             )
-            logging.info(f"Listening on port serial {self.config['Port']}")
+            logging.info("Listening on port serial %s", self.config["Port"])
+        
+        header = self.serial.read(len(self.HEADER))
+        if header and header != self.HEADER:
+            # Out of sync, skip ahead to the next frame
+            header = self.serial.read_until(self.HEADER)[-len(self.HEADER):]
         
-        data = self.serial.read_until(self.HEADER)
+        data = self.serial.read(self.BUFFER_SIZE+self.HASH_SIZE) if header == self.HEADER else None
         
         if not data:
             pass
         elif len(data) < self.BUFFER_SIZE+self.HASH_SIZE:
-            logging.debug(f"Didn't receive a full message, only recieved {len(data)} bytes")
-            self.serial.flush()
+            logging.debug("Didn't receive a full message, only recieved %s bytes", len(data))
         else:
             screen_data, hashcode = data[:self.BUFFER_SIZE], data[self.BUFFER_SIZE:self.BUFFER_SIZE+self.HASH_SIZE]
-            hasher = hashlib.md5()
-            hasher.update(screen_data)
-            check_hash = hasher.digest()[:self.HASH_SIZE]
+            check_hash = struct.pack("<I", zlib.crc32(screen_data))
             if check_hash == hashcode:
-                image = Image.frombytes("RGB", (16, 16), screen_data)
+                image = Image.frombuffer("RGB", (16, 16), screen_data, "raw", "RGB", 0, 1)
                 self.draw_to_screens(image)
             else:
-                logging.warning(f"Invalid hash {check_hash} != {hashcode}, message length {len(data)}")
-                self.serial.flush()
+                logging.warning("Invalid hash %s != %s, message length %s", check_hash, hashcode, len(data))
         
         if time.monotonic() > self._next_update:
             self.window.update()
@@ -1,21 +1,27 @@
 import argparse
 import os
+import re
+import json
 import logging
 import time
 import math
-from threading import Lock
-from collections import defaultdict
+import signal
+from typing import TYPE_CHECKING
 
-import commentjson
+import PIL
 from PIL import Image, ImageDraw
 
-from Animation import Animation
-from hardware.IHardware import IHardware
+if TYPE_CHECKING:
+    # Imported where used so a slave never loads imageio
+    from Animation import Animation
+    from hardware.IHardware import IHardware
 
 class App:
     """
         Main roboneo controller app
     """
+    PULSE_STEPS = 128  # Steps in one period of the idle pulse
+
     def __init__(self, config:dict, simulate:bool=False):
         """ Creates an instance of App
         
@@ -24,8 +30,8 @@ class App:
             simulate: Whether to simulate the hardware
         """
         self._current_expression = None
-        self._nextUpdate = time.monotonic()
-        self._update_lock = Lock()
+        self._current_animation = None
+        self._nextUpdate = time.monotonic_ns()
 
         logging.info("Loading hardware instance")
         if simulate:
@@ -36,28 +42,55 @@ class App:
             self._hardware = RaspberryPi(config, self.switch_to_expression)
 
         self.config = config
+        self._expression_pins = frozenset(config["Expression_pins"])
+        self._update_delay_ns = round(1e9 / config["Update_rate"])
+        self._frame_cache_limit = config["Frame_cache_limit"]
+
         self.animations_dir = os.path.join(os.path.dirname(__file__), "expressions")
         if not os.path.exists(self.animations_dir):
-            logging.info(f"Creating animation directory at {self.animations_dir}")
+            logging.info("Creating animation directory at %s", self.animations_dir)
             os.mkdir(self.animations_dir)
-        self.animations = defaultdict(lambda: None)
+        self.animations = {}
 
+        # Only used for the idle pattern, animation frames go straight to the hardware
         self.image = Image.new("RGB", (32, 16), "black")
         self.draw = ImageDraw.Draw(self.image)
 
-        logging.info("Loading expressions")
-        for file in os.listdir(self.animations_dir):
-            expression = os.path.splitext(file)[0]
-            if expression in config["Expression_pins"]:
-                self.load_animation(expression, os.path.join(self.animations_dir, file))
-            else:
-                logging.error(f"Could not map file '{file}' to any known expressions, unknown expression!")
+        # The idle pattern only changes where it pulses, so draw the rest once
+        self._idle_base = Image.new("RGB", (32, 16), "black")
+        idle_draw = ImageDraw.Draw(self._idle_base)
+        idle_draw.line((0, 0, 16, 16), "yellow")
+        idle_draw.line((16, 0, 32, 16), "yellow")
+
+        # Grey levels of abs(cos(3t)) over one period (pi/3 seconds)
+        self._pulse_colours = [(level, level, level) for level in (
+            round(255*abs(math.cos(math.pi * i / self.PULSE_STEPS))) for i in range(self.PULSE_STEPS)
+        )]
+        self._pulse_scale = 3 * self.PULSE_STEPS / math.pi
+
+        files = {}
+        with os.scandir(self.animations_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                expression = os.path.splitext(entry.name)[0]
+                if expression in files:
+                    logging.error("Ignoring file '%s', expression %s already uses '%s'!", entry.name, expression, files[expression].name)
+                else:
+                    files[expression] = entry
+
+        to_load = self._expression_pins & files.keys()
+        logging.info("Loading %s expressions", len(to_load))
+        for expression in to_load:
+            self.load_animation(expression, files[expression].path)
+        for expression in files.keys() - self._expression_pins:
+            logging.error("Could not map file '%s' to any known expressions, unknown expression!", files[expression].name)
         
         if config["Default"]:
             self.switch_to_expression(config["Default"])
     
     @property
-    def hardware(self) -> IHardware:
+    def hardware(self) -> "IHardware":
         """ Gets the currently active hardware controller """
         return self._hardware
 
@@ -71,79 +104,98 @@ class App:
         Raises:
             IndexError: If the expression doesn't exist
         """
-        if not expression_name in self.config["Expression_pins"]:
+        if not expression_name in self._expression_pins:
             raise IndexError(f"No such expression name '{expression_name}'")
 
-        slot = self.animations[expression_name]
+        slot = self.animations.get(expression_name)
         if slot is not None and slot.playing:
-            logging.warning(f"Stopping currently playing Animation instance to {expression_name}")
+            logging.warning("Stopping currently playing Animation instance to %s", expression_name)
             slot.stop()
         
-        logging.info(f"Loading expression {expression_name} at {filepath}")
-        self.animations[expression_name] = Animation(filepath, self.config["Frame_cache_limit"])
+        from Animation import Animation
+
+        logging.debug("Loading expression %s at %s", expression_name, filepath)
+        animation = Animation(filepath, self._frame_cache_limit, self.hardware.prepare_screen)
+        self.animations[expression_name] = animation
+
+        if expression_name == self._current_expression:
+            animation.start()
+            self._current_animation = animation
     
     @property
-    def current_animation(self) -> Animation:
+    def current_animation(self) -> "Animation":
         """ Gets the current animation playing """
-        return self.animations.get(self._current_expression, None)
+        return self._current_animation
     
     def switch_to_expression(self, expression_name:str):
         """ Switches to the given expression name
+        The new animation is started before it is swapped in, so update never sees it half set up
         
         Args:
             expression_name: The name of the expresison to switch to
         Raises:
             IndexError: If the expression doesn't exist
         """
-        if not expression_name in self.config["Expression_pins"]:
+        if not expression_name in self._expression_pins:
             raise IndexError(f"No such expression name '{expression_name}'")
         
-        with self._update_lock:
-            if expression_name == self._current_expression:
-                return
-            elif self.current_animation is not None:
-                self.current_animation.stop()
-            
-            logging.debug(f"Switching to expression {expression_name}")
-            self._current_expression = expression_name
-            if self.current_animation is None:
-                logging.warning(f"No animation tied to {expression_name} currently!")
-            else:
-                self.current_animation.start()
+        if expression_name == self._current_expression:
+            return
+        
+        logging.debug("Switching to expression %s", expression_name)
+        animation = self.animations.get(expression_name)
+        if animation is None:
+            logging.warning("No animation tied to %s currently!", expression_name)
+        else:
+            animation.start()
+        
+        previous = self._current_animation
+        self._current_expression = expression_name
+        self._current_animation = animation
+        if previous is not None:
+            previous.stop()
     
     def update(self):
         """ Renders and animations and displays to hardware """
-        with self._update_lock:
-            if self.current_animation:
-                frame = self.current_animation.get_frame()
-                self.image.paste(frame)
-            else:
-                self.draw.rectangle((0, 0, 32, 16), "black")
-                self.draw.line((0, 0, 16, 16), "yellow")
-                self.draw.line((16, 0, 32, 16), "yellow")
-                
-                pulse_colour = tuple([round(255*abs(math.cos(time.time()*3)))]*3)
-                self.draw.rectangle((7, 7, 9, 9), pulse_colour)
-                self.draw.rectangle((23, 7, 25, 9), pulse_colour)
-        
-        self.hardware.draw_to_screens(self.image)
-    
+        animation = self._current_animation  # Read once, a switch mid frame is picked up next frame
+        if animation is not None:
+            self.hardware.draw_split_to_screens(*animation.get_frame_split())
+        else:
+            self.image.paste(self._idle_base)
+            
+            pulse_colour = self._pulse_colours[int(time.monotonic() * self._pulse_scale) % self.PULSE_STEPS]
+            self.draw.rectangle((7, 7, 9, 9), pulse_colour)
+            self.draw.rectangle((23, 7, 25, 9), pulse_colour)
+            self.hardware.draw_to_screens(self.image)
+
     def mainloop(self):
         """ Runs the application indefinitely until the user closes it """
-        delay = (1/self.config["Update_rate"])
+        delay = self._update_delay_ns
+        update, sleep, monotonic_ns = self.update, time.sleep, time.monotonic_ns
+
+        stopping = False
+        def on_interrupt(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        # Ctrl-C finishes the current frame rather than raising out of the middle of it
+        previous_handler = signal.signal(signal.SIGINT, on_interrupt)
 
         logging.info("Running mainloop, press Ctrl-C to terminate")
-        while True:
-            try:
-                self.update()
+        try:
+            while not stopping:
+                update()
 
-                delta = self._nextUpdate - time.monotonic()
+                # Integer nanoseconds keep the schedule exact however long the app runs
+                delta = self._nextUpdate - monotonic_ns()
                 if delta > 0:
-                    time.sleep(delta)
-                self._nextUpdate += delay
-            except KeyboardInterrupt:
-                logging.info("Received keyboard interrupt, closing app...")
-                break
+                    sleep(delta / 1e9)
+                # Don't rush a burst of frames to catch up after a slow one
+                self._nextUpdate = max(self._nextUpdate + delay, monotonic_ns())
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+        
+        logging.info("Received keyboard interrupt, closing app...")
     
     def teardown(self):
         """ Shuts down any animation and currently running hardware """
@@ -154,6 +206,10 @@ class App:
         self.hardware.teardown()
 
 
+def _ignore_trigger(expression_name:str):
+    """ Trigger callback for the slave, which has no expressions to switch to """
+
+
 def slave_instance(config:dict, simulate:bool=False):
     """ Called to start the slave runner to receive data from the oposing Pi
     
@@ -163,22 +219,46 @@ def slave_instance(config:dict, simulate:bool=False):
     """
     if simulate:
         from hardware.Simulator import Simulator
-        hardware = Simulator(config, lambda trig: 1)
+        hardware = Simulator(config, _ignore_trigger)
     else:
         from hardware.RaspberryPi import RaspberryPi
-        hardware = RaspberryPi(config, lambda trig: 1)
+        hardware = RaspberryPi(config, _ignore_trigger)
     
+    write_serial_to_display = hardware.write_serial_to_display
+
     logging.info("Running mainloop, press Ctrl-C to terminate")
-    while True:
-        try:
-            hardware.write_serial_to_display()
-        except KeyboardInterrupt:
-            break
+    try:
+        while True:
+            write_serial_to_display()
+    except KeyboardInterrupt:
+        pass
     
     logging.info("Shutting down hardware")
     hardware.teardown()
 
 
+# Matches comments, or a whole string literal so comment markers inside strings are kept
+JSONC_COMMENT = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.DOTALL)
+
+def load_config(filepath:str) -> dict:
+    """ Loads a json file that may contain comments
+
+    Args:
+        filepath: The path to the config file
+    Returns:
+        dict: The loaded configuration
+    """
+    with open(filepath, "rb") as jfile:
+        data = jfile.read().decode("utf-8")
+    
+    try:
+        return json.loads(JSONC_COMMENT.sub(lambda match: match.group(1) or "", data))
+    except ValueError:
+        # Anything else commentjson allows, e.g. trailing commas
+        import commentjson
+        return commentjson.loads(data)
+
+
 def main():
     logging.basicConfig(
         format="%(asctime)s [%(levelname)s]: %(message)s",
@@ -198,8 +278,10 @@ def main():
     
     args = parser.parse_args()
 
-    with open(args.config, "rb") as jfile:
-        config = commentjson.load(jfile)
+    # Pillow-SIMD reports its version with a ".post" suffix
+    logging.debug("Using Pillow %s%s", PIL.__version__, " (SIMD)" if ".post" in PIL.__version__ else "")
+
+    config = load_config(args.config)
     
     if args.slave:
         slave_instance(config, args.simulate)